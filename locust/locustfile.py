@@ -13,12 +13,119 @@ Authentication: One shared API key is created at test start using Basic Auth.
 All users share this API key for their requests.
 """
 
-from locust import HttpUser, SequentialTaskSet, task, between, events
+from locust import FastHttpUser, LoadTestShape, SequentialTaskSet, task, between, events
+import base64
+import gc
+import logging
 import os
 import random
+import socket
 import time
 import json
-from io import BytesIO
+import gevent
+import gevent.lock
+from pathlib import Path
+from urllib.parse import urlparse
+
+# Prefer orjson for hot-path response parsing (json.loads is a top frame in
+# high-RPS Locust profiles); fall back to stdlib if it isn't installed.
+# orjson raises a ValueError subclass, so callers catch ValueError, which
+# also covers stdlib json.JSONDecodeError.
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# Debug output goes through logging (disabled at WARNING level by default)
+# rather than print(): per-request stdout writes serialize greenlets on the
+# stdout lock at high user counts.
+logger = logging.getLogger(__name__)
+logging.getLogger('locust').setLevel(logging.WARNING)
+
+# Batch status polling tuning (overridable via environment)
+POLL_INITIAL = float(os.getenv('POLL_INITIAL', '2'))        # First poll interval (seconds)
+POLL_MAX = float(os.getenv('POLL_MAX', '60'))               # Interval cap (seconds)
+POLL_GROWTH = float(os.getenv('POLL_GROWTH', '1.8'))        # Backoff multiplier on unchanged status
+POLL_DEADLINE_S = float(os.getenv('POLL_DEADLINE_S', '600'))  # Total wall-clock budget per batch
+
+# Fraction of workflows that re-fetch the file after upload. Real clients
+# rarely do this, so sample it instead of paying a GET per iteration.
+VERIFY_UPLOAD_RATE = float(os.getenv('VERIFY_UPLOAD_RATE', '0.1'))
+
+# STRESS_MODE=1 trades response inspection for throughput: downloads are
+# validated on status code alone without materializing the body, and batch
+# creation extracts the id with a substring scan instead of a full JSON parse.
+STRESS_MODE = os.getenv('STRESS_MODE', '0') == '1'
+
+
+def _err_snip(response, n=256):
+    """Short error-body excerpt for failure messages.
+
+    response.text decodes the entire body (with charset detection); during a
+    failure storm every request would pay that exactly when the load
+    generator is already saturated. Decode at most n bytes instead.
+    """
+    return response.content[:n].decode('utf-8', 'replace') if response.content else ''
+
+
+def _scan_for_id(content):
+    """Pull the "id" field out of a JSON body without parsing it.
+
+    Good enough for the compact JSON the API returns; returns None if the
+    field isn't found so callers can fall back to a real parse.
+    """
+    marker = b'"id":"'
+    start = content.find(marker)
+    if start == -1:
+        return None
+    start += len(marker)
+    end = content.find(b'"', start)
+    if end == -1:
+        return None
+    return content[start:end].decode('ascii', 'replace')
+
+
+def _load_test_data_bytes():
+    """Load JSONL test data from file once at import.
+
+    The payload never changes between requests, so reading and encoding it
+    per user (or per request) is pure overhead at high user counts.
+    """
+    # Support environment variable override for selecting test data size
+    test_data_file = os.getenv('TEST_DATA_FILE', '/test_data/batch_input_medium.jsonl')
+
+    # Fallback chain: try specified file -> use minimal data
+    try:
+        with open(test_data_file, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        # Fallback to minimal test data
+        return b'{"custom_id": "req-1", "method": "POST", "url": "/v1/chat/completions", "body": {"model": "load-test", "messages": [{"role": "user", "content": "Hello"}], "max_tokens": 100}}\n'
+
+
+_TEST_DATA_BYTES = _load_test_data_bytes()
+
+# The upload payload (filename, purpose, contents) never changes, so the
+# entire multipart/form-data body is assembled exactly once and reused for
+# every upload. geventhttpclient (used by FastHttpUser) doesn't accept
+# requests-style `files=` anyway, so the body is built by hand.
+_BOUNDARY = '----locustbatch' + os.urandom(8).hex()
+_UPLOAD_BODY = (
+    f'--{_BOUNDARY}\r\n'
+    'Content-Disposition: form-data; name="purpose"\r\n'
+    '\r\n'
+    'batch\r\n'
+    f'--{_BOUNDARY}\r\n'
+    'Content-Disposition: form-data; name="file"; filename="batch_input.jsonl"\r\n'
+    'Content-Type: application/octet-stream\r\n'
+    '\r\n'
+).encode('utf-8') + _TEST_DATA_BYTES + f'\r\n--{_BOUNDARY}--\r\n'.encode('utf-8')
+_UPLOAD_CT = f'multipart/form-data; boundary={_BOUNDARY}'
+
+# Load-test processes are short-lived but allocation-heavy; raising the gen-0
+# threshold keeps cyclic GC sweeps off the request hot path and flattens P99.
+gc.set_threshold(100000, 10, 10)
 
 
 class BatchWorkflow(SequentialTaskSet):
@@ -33,77 +140,58 @@ class BatchWorkflow(SequentialTaskSet):
         self.batch_id = None
         self.output_file_id = None
         self.error_file_id = None
-        self.test_data = self.load_test_data()
-
-    def load_test_data(self):
-        """Load JSONL test data from file"""
-        # Support environment variable override for selecting test data size
-        test_data_file = os.getenv('TEST_DATA_FILE', '/test_data/batch_input_medium.jsonl')
-
-        # Fallback chain: try specified file -> try batch_input.jsonl -> use minimal data
-        try:
-            with open(test_data_file, 'r') as f:
-                return f.read()
-        except FileNotFoundError:
-            # Fallback to minimal test data
-            return '{"custom_id": "req-1", "method": "POST", "url": "/v1/chat/completions", "body": {"model": "load-test", "messages": [{"role": "user", "content": "Hello"}], "max_tokens": 100}}\n'
+        self.test_data = _TEST_DATA_BYTES
 
+        # Everything except input_file_id is constant for this user, so
+        # build it once instead of reconstructing the dict per create_batch
+        self._base_batch_payload = {
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+            "metadata": {
+                "test_run": "locust",
+                "locust_user": str(id(self))
+            }
+        }
 
     @task
     def upload_file(self):
         """Step 1: Upload JSONL batch input file"""
-        # Create file-like object from test data
-        test_data_bytes = self.test_data.encode('utf-8') if isinstance(self.test_data, str) else self.test_data
-        file_obj = BytesIO(test_data_bytes)
-
-        # Debug: Print first 200 chars of test data
-        print(f"[DEBUG] Uploading file with {len(test_data_bytes)} bytes, first 200 chars: {test_data_bytes[:200]}")
-
-        # OpenAI's exact format: file as tuple (filename, file_object)
-        files = {
-            'file': ('batch_input.jsonl', file_obj)
-        }
-
-        # purpose as form data
-        data = {
-            'purpose': 'batch'
-        }
-
-        # Don't set Content-Type - let requests handle multipart/form-data
-        print(f"[DEBUG] Posting to: {self.client.base_url}/ai/v1/files")
-
         with self.client.post(
             "/ai/v1/files",
-            files=files,
-            data=data,
+            data=_UPLOAD_BODY,
+            headers={'Content-Type': _UPLOAD_CT},
             catch_response=True,
             name="/ai/v1/files [upload]"
         ) as response:
-            print(f"[DEBUG] Upload response: status={response.status_code}")
-            print(f"[DEBUG] Response headers: {dict(response.headers)}")
-            print(f"[DEBUG] Response body: {response.text[:500]}")
-            if 'allow' in response.headers:
-                print(f"[DEBUG] Allowed methods: {response.headers['allow']}")
+            if logger.isEnabledFor(logging.DEBUG):
+                # Guarded: dict(headers) and text slicing allocate per request
+                logger.debug("Upload response: status=%s headers=%s body=%s",
+                             response.status_code, dict(response.headers), response.text[:500])
             if response.status_code in [200, 201]:
                 try:
-                    response_data = response.json()
+                    response_data = _loads(response.content)
                     self.file_id = response_data.get('id')
                     if not self.file_id:
-                        response.failure(f"No file ID in response: {response.text}")
+                        response.failure(f"No file ID in response: {_err_snip(response)}")
                     else:
                         response.success()
-                except (json.JSONDecodeError, KeyError) as e:
-                    response.failure(f"Failed to parse response: {e}. Raw response: {response.text}")
+                except (ValueError, KeyError) as e:
+                    response.failure(f"Failed to parse response: {e}. Raw response: {_err_snip(response)}")
             else:
-                response.failure(f"Upload failed: {response.status_code} - {response.text}")
+                response.failure(f"Upload failed: {response.status_code} - {_err_snip(response)}")
 
     @task
     def verify_upload(self):
-        """Step 2: Verify file was uploaded successfully"""
+        """Step 2: Verify file was uploaded successfully (sampled)"""
         if not self.file_id:
             self.interrupt()
             return
 
+        # Only verify a sample of uploads; the endpoint still gets exercised
+        # without adding a guaranteed GET to every workflow
+        if random.random() >= VERIFY_UPLOAD_RATE:
+            return
+
         # Randomly choose between metadata or content verification
         if random.random() < 0.5:
             # Get metadata
@@ -135,15 +223,7 @@ class BatchWorkflow(SequentialTaskSet):
             self.interrupt()
             return
 
-        payload = {
-            "input_file_id": self.file_id,
-            "endpoint": "/v1/chat/completions",
-            "completion_window": "24h",
-            "metadata": {
-                "test_run": "locust",
-                "locust_user": str(id(self))
-            }
-        }
+        payload = {"input_file_id": self.file_id, **self._base_batch_payload}
 
         with self.client.post(
             "/ai/v1/batches",
@@ -152,14 +232,21 @@ class BatchWorkflow(SequentialTaskSet):
             name="/ai/v1/batches [create]"
         ) as response:
             if response.status_code in [200, 201]:
+                if STRESS_MODE:
+                    # Substring scan beats json.loads when parsing dominates
+                    # the profile; fall through to a real parse if it misses
+                    self.batch_id = _scan_for_id(response.content)
+                    if self.batch_id:
+                        response.success()
+                        return
                 try:
-                    data = response.json()
+                    data = _loads(response.content)
                     self.batch_id = data.get('id')
                     response.success()
-                except (json.JSONDecodeError, KeyError) as e:
+                except (ValueError, KeyError) as e:
                     response.failure(f"Failed to parse batch response: {e}")
             else:
-                response.failure(f"Batch creation failed: {response.status_code} - {response.text}")
+                response.failure(f"Batch creation failed: {response.status_code} - {_err_snip(response)}")
 
     @task
     def poll_batch_status(self):
@@ -168,18 +255,27 @@ class BatchWorkflow(SequentialTaskSet):
             self.interrupt()
             return
 
-        max_polls = 60  # Maximum number of polls
-        poll_interval = 2  # Start with 2 seconds
+        # Adaptive polling: back off while the status is unchanged, reset to
+        # the initial interval on a state transition (e.g. validating ->
+        # in_progress), and bound total wall-clock time rather than poll count.
+        poll_interval = POLL_INITIAL
+        last_status = None
+        deadline = time.monotonic() + POLL_DEADLINE_S
+
+        # Hoisted out of the loop: the URL and stats name are identical on
+        # every poll, no need to rebuild them per tick
+        url = f"/ai/v1/batches/{self.batch_id}"
+        name = "/ai/v1/batches/{batch_id} [poll]"
 
-        for i in range(max_polls):
+        while time.monotonic() < deadline:
             with self.client.get(
-                f"/ai/v1/batches/{self.batch_id}",
+                url,
                 catch_response=True,
-                name="/ai/v1/batches/{batch_id} [poll]"
+                name=name
             ) as response:
                 if response.status_code == 200:
                     try:
-                        data = response.json()
+                        data = _loads(response.content)
                         status = data.get('status')
 
                         if status in ['completed', 'failed', 'cancelled', 'expired']:
@@ -194,19 +290,26 @@ class BatchWorkflow(SequentialTaskSet):
                         else:
                             response.failure(f"Unknown batch status: {status}")
                             return
-                    except (json.JSONDecodeError, KeyError) as e:
+                    except (ValueError, KeyError) as e:
                         response.failure(f"Failed to parse poll response: {e}")
                         return
                 else:
                     response.failure(f"Poll failed: {response.status_code}")
                     return
 
-            # Exponential backoff with cap
-            time.sleep(poll_interval)
-            poll_interval = min(poll_interval * 1.5, 30)  # Cap at 30 seconds
+            if status != last_status:
+                # State changed - poll eagerly again
+                last_status = status
+                poll_interval = POLL_INITIAL
+            else:
+                # Unchanged - back off
+                poll_interval = min(poll_interval * POLL_GROWTH, POLL_MAX)
 
-        # Reached max polls without completion
-        print(f"Batch {self.batch_id} did not complete within {max_polls} polls")
+            # gevent.sleep (not time.sleep) so other greenlets run during the wait
+            gevent.sleep(poll_interval)
+
+        # Reached deadline without completion
+        logger.warning("Batch %s did not complete within %ss", self.batch_id, POLL_DEADLINE_S)
 
     @task
     def retrieve_output(self):
@@ -215,12 +318,22 @@ class BatchWorkflow(SequentialTaskSet):
             # No output file, skip
             return
 
+        url = f"/ai/v1/files/{self.output_file_id}/content"
+
         with self.client.get(
-            f"/ai/v1/files/{self.output_file_id}/content",
+            url,
             name="/ai/v1/files/{output_file_id}/content [output]",
-            catch_response=True
+            catch_response=True,
+            stream=STRESS_MODE  # status-only validation; don't buffer the body
         ) as response:
             if response.status_code == 200:
+                if STRESS_MODE:
+                    # Output files can be many MB of JSONL; read and discard
+                    # in chunks so the body never sits in memory and the
+                    # connection is drained for reuse (FastResponse has no
+                    # iter_content, only the raw stream)
+                    while response.stream.read(65536):
+                        pass
                 response.success()
             else:
                 response.failure(f"Failed to retrieve output: {response.status_code}")
@@ -232,28 +345,50 @@ class BatchWorkflow(SequentialTaskSet):
             # No error file, skip
             return
 
+        url = f"/ai/v1/files/{self.error_file_id}/content"
+
         with self.client.get(
-            f"/ai/v1/files/{self.error_file_id}/content",
+            url,
             name="/ai/v1/files/{error_file_id}/content [errors]",
-            catch_response=True
+            catch_response=True,
+            stream=STRESS_MODE  # status-only validation; don't buffer the body
         ) as response:
             if response.status_code == 200:
+                if STRESS_MODE:
+                    # Drain and discard, same as retrieve_output
+                    while response.stream.read(65536):
+                        pass
                 response.success()
             else:
                 response.failure(f"Failed to retrieve errors: {response.status_code}")
 
 
-class BatchUser(HttpUser):
+class BatchUser(FastHttpUser):
     """
     Simulates a user performing batch operations.
     Uses Basic Auth to create API key, then uses API key for all requests.
+
+    Uses FastHttpUser (geventhttpclient) instead of HttpUser (python-requests)
+    for much lower per-request CPU cost at high user counts.
     """
     tasks = [BatchWorkflow]
     wait_time = between(1, 3)  # Wait 1-3 seconds between workflows
 
-    # Shared API key across all users (class variable)
+    network_timeout = 60.0
+    connection_timeout = 60.0
+    default_headers = {'User-Agent': 'Locust-LoadTest/1.0'}
+
+    # Size of each user's connection pool. FastHttpUser gives every user its
+    # own geventhttpclient pool, so concurrent greenlets never queue behind a
+    # shared requests-style pool ("Connection pool is full" warnings), and a
+    # source-port-hashing LB sees multiple ephemeral ports per user.
+    concurrency = int(os.getenv('CLIENT_POOL_CONCURRENCY', '10'))
+
+    # Shared API key across all users (class variables). The lock ensures a
+    # spawn storm doesn't race past the None check and flood the admin
+    # endpoint with parallel key-creation requests.
     shared_api_key = None
-    api_key_lock = None
+    api_key_lock = gevent.lock.Semaphore()
 
     def on_start(self):
         """Set up authentication - create shared API key or use existing one"""
@@ -261,24 +396,16 @@ class BatchUser(HttpUser):
         password = os.getenv('BASIC_AUTH_PASSWORD', 'password')
 
         # Set up Basic Auth initially
-        self.client.auth = (username, password)
+        credentials = base64.b64encode(f'{username}:{password}'.encode('utf-8')).decode('ascii')
+        self.client.auth_header = f'Basic {credentials}'
 
-        # Set headers
-        self.client.headers.update({
-            'User-Agent': 'Locust-LoadTest/1.0'
-        })
+        # Only the first user through the lock creates the key; the rest wait
+        with BatchUser.api_key_lock:
+            if BatchUser.shared_api_key is None:
+                self._create_shared_api_key()
 
-        # Create or retrieve shared API key
-        if BatchUser.shared_api_key is None:
-            # Only the first user creates the API key
-            self._create_shared_api_key()
-        else:
-            # Other users just use the existing key
-            print(f"[DEBUG] Using existing shared API key")
-            self.client.headers.update({
-                'Authorization': f'Bearer {BatchUser.shared_api_key}'
-            })
-            self.client.auth = None
+        if BatchUser.shared_api_key:
+            self.client.auth_header = f'Bearer {BatchUser.shared_api_key}'
 
     def _create_shared_api_key(self):
         """Create a single shared API key for all users"""
@@ -292,7 +419,7 @@ class BatchUser(HttpUser):
             "requests_per_second": 0
         }
 
-        print(f"[DEBUG] Creating shared API key at {api_key_endpoint}")
+        logger.debug("Creating shared API key at %s", api_key_endpoint)
 
         response = self.client.post(
             api_key_endpoint,
@@ -306,23 +433,56 @@ class BatchUser(HttpUser):
                 BatchUser.shared_api_key = response_data.get('key')
 
                 if BatchUser.shared_api_key:
-                    print(f"[DEBUG] Created shared API key: {BatchUser.shared_api_key[:20]}...")
-                    # Switch to Bearer token
-                    self.client.headers.update({
-                        'Authorization': f'Bearer {BatchUser.shared_api_key}'
-                    })
-                    self.client.auth = None
+                    logger.debug("Created shared API key: %s...", BatchUser.shared_api_key[:20])
                 else:
-                    print(f"[ERROR] No API key in response: {response.text}")
+                    logger.error("No API key in response: %s", response.text)
             except (json.JSONDecodeError, KeyError) as e:
-                print(f"[ERROR] Failed to parse API key response: {e}")
+                logger.error("Failed to parse API key response: %s", e)
         else:
-            print(f"[ERROR] API key creation failed: {response.status_code} - {response.text}")
+            logger.error("API key creation failed: %s - %s", response.status_code, response.text)
+
+
+if os.getenv('USE_LOAD_SHAPE', '0') == '1':
+    # Only defined on opt-in: a LoadTestShape in the locustfile makes locust
+    # ignore --users/--spawn-rate/--run-time, which would break the chart's
+    # profile-driven runs (smoke/load/stress/soak all pass those flags).
+    class GradualLoadShape(LoadTestShape):
+        """
+        Stage-based ramp-up instead of spawning all users at once.
+
+        Spawning thousands of users from t=0 creates a connection storm
+        against the files and admin endpoints before the shared API key is
+        even cached, contaminating startup latency percentiles. Durations
+        are cumulative.
+        """
+        stages = [
+            {"duration": 60,  "users": 500,  "spawn_rate": 50},
+            {"duration": 180, "users": 1500, "spawn_rate": 100},
+            {"duration": 360, "users": 3000, "spawn_rate": 100},
+            {"duration": 900, "users": 3000, "spawn_rate": 100},
+        ]
+
+        def tick(self):
+            run_time = self.get_run_time()
+            for stage in self.stages:
+                if run_time < stage["duration"]:
+                    return (stage["users"], stage["spawn_rate"])
+            return None
 
 
 @events.test_start.add_listener
 def on_test_start(environment, **kwargs):
     """Event handler for test start"""
+    # Resolve the target host once up front so the resolver cache is warm
+    # before users start issuing requests (the wrapper sets GEVENT_RESOLVER
+    # to ares so lookups don't block the hub)
+    hostname = urlparse(environment.host).hostname if environment.host else None
+    if hostname:
+        try:
+            socket.gethostbyname(hostname)
+        except OSError as e:
+            logger.warning("Could not pre-resolve %s: %s", hostname, e)
+
     print("\n" + "=" * 60)
     print("Starting Batch API Load Test")
     print("=" * 60)
@@ -369,18 +529,25 @@ def on_test_stop(environment, **kwargs):
             "endpoints": {}
         }
 
-        for name, stat in stats.entries.items():
-            if name and name != "Aggregated":
-                metrics["endpoints"][name] = {
-                    "requests": stat.num_requests,
-                    "failures": stat.num_failures,
-                    "avg_response_time_ms": stat.avg_response_time,
-                    "p95_ms": stat.get_response_time_percentile(0.95)
-                }
-
-        # Write to file
-        with open('/results/metrics.json', 'w') as f:
-            json.dump(metrics, f, indent=2)
+        # Single pass: snapshot the cheap counters first and only walk the
+        # response-time histogram (percentile) for entries that saw traffic.
+        # stats.entries is keyed by (name, method) tuples.
+        for (name, method), stat in stats.entries.items():
+            if not stat.num_requests:
+                continue
+            stat_summary = {
+                "requests": stat.num_requests,
+                "failures": stat.num_failures,
+                "avg_response_time_ms": stat.avg_response_time,
+            }
+            stat_summary["p95_ms"] = stat.get_response_time_percentile(0.95)
+            metrics["endpoints"][f"{method} {name}"] = stat_summary
+
+        # Compact separators and a single write: indented JSON formats per
+        # key and is surprisingly slow with many endpoint entries, and
+        # teardown can race the k8s job timeout
+        payload = json.dumps(metrics, separators=(',', ':')).encode('utf-8')
+        Path('/results/metrics.json').write_bytes(payload)
 
         print("Metrics exported to /results/metrics.json")
     except Exception as e: